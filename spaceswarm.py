@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
-import random, os, sys, time, math, pygame
+import random, os, sys, time, math, gc, zlib, threading, subprocess, pygame
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from vector2 import Vector2
+from stats import StatsStore
 from pygame.locals import *
 
 SPACESWARM_VERSION = (0, 5, 0)
@@ -16,15 +21,97 @@ WINDOWWIDTH, WINDOWHEIGHT = 800, 600
 TEXTCOLOR = WHITE
 BACKGROUNDCOLOR = BLACK
 FPS = 40
+MISSED_FRAME = 1.5 # frames longer than this many frame budgets count as missed
+PIXEL_COLLISION = True # check masks once the rects overlap
+MANAGED_GC = True # only run full collections between levels and when paused
+MEMORY_STATS = False # print gc and memory numbers per level on exit
+SEED = None # set to replay the same spawns and movement every game
+CAPTURE = None # 'raw', 'png' or 'pipe' to record every frame of play
+CAPTURE_DIR = 'capture'
+CAPTURE_COMMAND = ('ffmpeg -y -f rawvideo -pix_fmt bgr0 -s %dx%d -r %d -i - '
+                   'capture.mp4' % (WINDOWWIDTH, WINDOWHEIGHT, FPS))
+CAPTURE_QUEUE = 8 # frames waiting to be written before we start dropping
+IDLE_TIMEOUT = 500 # ms to block for events on menus before checking again
+PAUSE_MINIMIZED = True # stop simulating and drawing while minimized
+UNFOCUSED_FPS = 10 # frames drawn per second while the window lacks focus
+IDLE_STATS = False # print cpu time spent in each state on exit
+STATS_FILE = 'spaceswarm.db' # sqlite file for session statistics, or None
+PACING = 'sleep' # 'sleep', 'hybrid' (sleep, then busy-wait) or 'vsync'
+PACING_STATS = False # print frame interval jitter and latency on exit
 
 EASY = -10
 MEDIUM = 0
 HARD = 10
 
-random.seed()
+class RandomStream(object):
+    """
+    A seeded source of random numbers for one subsystem. Values are drawn
+    from the generator a block at a time and handed out from the buffer, so
+    the per-call cost in the game loop is a list pop.
+    """
+    def __init__(self, seed, block_size=512):
+        self._rng = random.Random(seed)
+        self._block_size = block_size
+        self._buffer = []
+
+    def seed(self, seed):
+        self._rng.seed(seed)
+        self._buffer = []
+
+    def random(self):
+        if not self._buffer:
+            r = self._rng.random
+            self._buffer = [r() for i in range(self._block_size)]
+        return self._buffer.pop()
+
+    def randint(self, a, b):
+        """ Random integer in the range [a, b], like random.randint """
+        return a + int(self.random() * (b - a + 1))
+
+    def shuffle(self, seq):
+        for i in range(len(seq) - 1, 0, -1):
+            j = int(self.random() * (i + 1))
+            seq[i], seq[j] = seq[j], seq[i]
+
+
+class RandomService(object):
+    """
+    Hands out one RandomStream per subsystem, each seeded from the base seed
+    and the stream name. A subsystem drawing more or fewer numbers does not
+    shift the sequence seen by any other.
+    """
+    def __init__(self, seed=None):
+        self._streams = {}
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        if seed is None:
+            seed = random.SystemRandom().randint(0, 2**31 - 1)
+        self.base_seed = seed
+        for name, stream in self._streams.items():
+            stream.seed(self._stream_seed(name))
+
+    def stream(self, name):
+        if name not in self._streams:
+            self._streams[name] = RandomStream(self._stream_seed(name))
+        return self._streams[name]
+
+    def _stream_seed(self, name):
+        return (self.base_seed << 32) | (zlib.crc32(name.encode('ascii'))
+                                         & 0xffffffff)
+
+rng = RandomService(SEED)
 pygame.init()
 pygame.mouse.set_visible(False) # we blit the mouse instead
-screen = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
+pacing = PACING
+if pacing == 'vsync':
+    try: # pygame 2 only, and only honoured for SCALED or OPENGL displays
+        screen = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT),
+                                         pygame.SCALED, vsync=1)
+    except (AttributeError, TypeError, pygame.error):
+        pacing = 'hybrid' # the closest we can get without vsync
+if pacing != 'vsync':
+    screen = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
 pygame.display.set_caption('Space Swarm!')
 
 def load_image(name):
@@ -36,6 +123,13 @@ def load_image(name):
         image = image.convert_alpha()
     return image, image.get_rect()
 
+_masks = {}
+def get_mask(surface):
+    """ Masks are computed once per image and shared by all sprites """
+    if surface not in _masks:
+        _masks[surface] = pygame.mask.from_surface(surface)
+    return _masks[surface]
+
 def load_sound(name):
     class NoneSound:
         def play(self): pass
@@ -44,20 +138,51 @@ def load_sound(name):
     return pygame.mixer.Sound(fullname)
 
 def terminate():
+    memory_monitor.report()
+    idle.report()
+    pacer.report()
+    if frame_recorder: frame_recorder.stop()
+    if session:
+        stats.end_level(session, level_controller.level, level_started,
+                        frame_times, pacer.missed_ms())
+        stats.end_session(session, 'quit', level_controller.level)
+    stats.close()
     pygame.quit()
     sys.exit()
 
-def wait_for_player():
+def wait_for_player(state='menu'):
+    idle.enter(state)
     while True:
-        for event in pygame.event.get():
-            clock.tick(FPS)
-            if event.type == QUIT:
+        event = idle.wait()
+        if event.type == QUIT:
+            terminate()
+        if event.type == KEYDOWN:
+            if event.key == K_ESCAPE:
                 terminate()
-            if event.type == KEYDOWN:
-                if event.key == K_ESCAPE:
-                    terminate()
-                if not event.key in [K_RCTRL, K_LCTRL, K_RALT, K_LALT, K_TAB]:
-                    return event.key
+            if not event.key in [K_RCTRL, K_LCTRL, K_RALT, K_LALT, K_TAB]:
+                idle.enter('playing')
+                pacer.reset() # don't count the wait as game time
+                return event.key
+
+def window_visible():
+    # there is no window to minimize when running headless
+    return pygame.display.get_active() or \
+           pygame.display.get_driver() == 'dummy'
+
+def window_focused():
+    return pygame.key.get_focused() or \
+           pygame.display.get_driver() == 'dummy'
+
+def wait_for_window():
+    """ Blocks until the window is restored """
+    idle.enter('background')
+    while not window_visible():
+        event = idle.wait()
+        if event.type == QUIT or \
+               (event.type == KEYDOWN and event.key == K_ESCAPE):
+            terminate()
+    idle.enter('playing')
+    pacer.reset()
 
 def get_n_points_on_circle(center, radius, n=10):
     alpha = math.pi * 2. / n
@@ -69,6 +194,69 @@ def get_n_points_on_circle(center, radius, n=10):
         points[i] = center + point_on_circle
     return points
 
+def _pixels_collide(a, b):
+    return not PIXEL_COLLISION or pygame.sprite.collide_mask(a, b) is not None
+
+def spritecollide(sprite, group, dokill):
+    """
+    Like pygame.sprite.spritecollide, but rect hits are only a broad phase;
+    the masks are compared for those candidates alone.
+    """
+    hits = [s for s in pygame.sprite.spritecollide(sprite, group, 0)
+            if _pixels_collide(sprite, s)]
+    if dokill:
+        for s in hits: s.kill()
+    return hits
+
+def sweptcollide(groupa, movers, dokilla, dokillb):
+    """
+    Like pygame.sprite.groupcollide, but each mover is tested along the
+    whole path from its last_rect to its rect, so fast movers or long
+    frames can't carry it through a sprite between two positions. The box
+    around the path is the broad phase; with PIXEL_COLLISION the masks are
+    compared along it. A mover only hits the first sprite on its path.
+    """
+    sprites = groupa.sprites()
+    rects = [a.rect for a in sprites]
+    hits = {}
+    for b in movers:
+        path = b.last_rect.union(b.rect)
+        first, first_t = None, None
+        for i in path.collidelistall(rects):
+            t = _swept_hit(b, sprites[i])
+            if t is not None and (first_t is None or t < first_t):
+                first, first_t = sprites[i], t
+        if first is not None:
+            hits.setdefault(first, []).append(b)
+    _kill_hits(hits, dokilla, dokillb)
+    return hits
+
+def _swept_hit(mover, sprite):
+    """
+    How far along its path (0 to 1) the mover first touches sprite, or
+    None. The path is walked in steps no longer than the mover itself.
+    """
+    x, y = mover.last_rect.topleft
+    dx, dy = mover.rect.x - x, mover.rect.y - y
+    size = max(1, min(mover.rect.width, mover.rect.height))
+    steps = max(1, int(math.ceil(max(abs(dx), abs(dy)) / float(size))))
+    for i in range(steps + 1):
+        t = i / float(steps)
+        px, py = int(round(x + dx * t)), int(round(y + dy * t))
+        if PIXEL_COLLISION:
+            offset = (sprite.rect.x - px, sprite.rect.y - py)
+            if mover.mask.overlap(sprite.mask, offset) is not None:
+                return t
+        elif sprite.rect.colliderect((px, py) + mover.rect.size):
+            return t
+    return None
+
+def _kill_hits(hits, dokilla, dokillb):
+    for a, collided in hits.items():
+        if dokilla: a.kill()
+        if dokillb:
+            for b in collided: b.kill()
+
 def draw_text(text, font, surface, x, y, color=TEXTCOLOR):
     text = font.render(text, 1, color)
     rect = text.get_rect()
@@ -76,10 +264,74 @@ def draw_text(text, font, surface, x, y, color=TEXTCOLOR):
     surface.blit(text, rect)
 
 
+class EntityRegistry(object):
+    """
+    Keeps track of every game object, by kind (the class attribute kind,
+    which is what collisions, updates and drawing work on) and by class.
+    Each game starts with a fresh registry, which every game object is
+    given when it is created.
+    """
+    kinds = ('player', 'aliens', 'bullets', 'effects') # in drawing order
+
+    def __init__(self):
+        self.groups = dict((kind, pygame.sprite.RenderUpdates())
+                           for kind in EntityRegistry.kinds)
+        self._types = {}
+
+    aliens = property(lambda self: self.groups['aliens'])
+    bullets = property(lambda self: self.groups['bullets'])
+
+    def groups_for(self, klass):
+        """ The groups a new instance of klass belongs in """
+        if klass not in self._types:
+            self._types[klass] = pygame.sprite.Group()
+        return self.groups[klass.kind], self._types[klass]
+
+    def spawn(self, klass, args):
+        """ One instance of klass for every constructor argument in args """
+        return [klass(self, arg) for arg in args]
+
+    def clear(self, kind):
+        """
+        Removes every object of a kind by swapping in empty groups, so a
+        full screen costs no more than a single alien. Returns how many of
+        each class were removed.
+
+        The dropped objects are not told; they still point at their old
+        groups (and so stay alive() to anyone holding on to them) until
+        the garbage collector frees them together.
+        """
+        counts = {}
+        for klass, group in list(self._types.items()):
+            if klass.kind == kind:
+                if group:
+                    counts[klass] = len(group)
+                self._types[klass] = pygame.sprite.Group()
+        self.groups[kind] = pygame.sprite.RenderUpdates()
+        return counts
+
+    def update(self, time_passed):
+        for kind in EntityRegistry.kinds:
+            self.groups[kind].update(time_passed)
+
+    def draw(self, surface):
+        for kind in EntityRegistry.kinds:
+            self.groups[kind].draw(surface)
+
+
 class GameObject(pygame.sprite.Sprite):
-    def __init__(self, image, rect, destination=None):
-        pygame.sprite.Sprite.__init__(self, self.containers)
+    created = {} # instances per class name, for the memory stats
+    samples = {} # a new instance per class waiting to be measured
+    kind = 'effects'
+
+    def __init__(self, registry, image, rect, destination=None):
+        pygame.sprite.Sprite.__init__(self, registry.groups_for(type(self)))
+        name = type(self).__name__
+        GameObject.created[name] = GameObject.created.get(name, 0) + 1
+        if MEMORY_STATS and name not in GameObject.samples:
+            GameObject.samples[name] = self
         self.image = image[0]
+        self.mask = get_mask(self.image)
         self.rect = rect
         self.destination = destination
 
@@ -94,11 +346,12 @@ class GameObject(pygame.sprite.Sprite):
 
 class Player(GameObject):
     image = load_image("player.png")
+    kind = 'player'
 
-    def __init__(self):
+    def __init__(self, registry):
         rect = Player.image[1]
         rect.center = (WINDOWWIDTH / 2, WINDOWHEIGHT / 2)
-        GameObject.__init__(self, Player.image, rect)
+        GameObject.__init__(self, registry, Player.image, rect)
 
     def update(self, time_passed):
         pass
@@ -106,8 +359,8 @@ class Player(GameObject):
 class Explosion(GameObject):
     image = load_image("explosion.png")
 
-    def __init__(self, rect):
-        GameObject.__init__(self, Explosion.image, rect)
+    def __init__(self, registry, rect):
+        GameObject.__init__(self, registry, Explosion.image, rect)
         self._ttl = 5 # number of frames explosion should be visible
 
     def update(self, time_passed):
@@ -118,37 +371,42 @@ class Explosion(GameObject):
 class Alien(GameObject):
     image = load_image("alien.png")
     width, height = image[0].get_size()
+    kind = 'aliens'
+    reward = 7.5 # firepower for a kill
+    jitter = rng.stream('jitter')
+    spawns = rng.stream('spawn')
 
-    def __init__(self, speed=100, img=None):
+    def __init__(self, registry, speed=100, img=None):
         if img is None: img = Alien.image
-        GameObject.__init__(self, img,
+        GameObject.__init__(self, registry, img,
                             self._random_spawn_rect(),
                             (WINDOWWIDTH/2, WINDOWHEIGHT/2))
         self._speed = speed
 
     def speed(self):
         """ Gives a slight random variation in speed for every alien """
-        return self._speed + random.randint(-5, 5)
+        return self._speed + Alien.jitter.randint(-5, 5)
 
     def _random_spawn_rect(self):
         """
         Figures out where the alien should be spawned, which should be somewhere
         along the edges of the screen.
         """
-        spawn_loc = random.randint(0, 3)
+        spawns = Alien.spawns
+        spawn_loc = spawns.randint(0, 3)
         x,y = 0,0
         if spawn_loc == 0: # top
-            x = random.randint(0, WINDOWWIDTH)
+            x = spawns.randint(0, WINDOWWIDTH)
             y = 0
         elif spawn_loc == 1: # right
             x = WINDOWWIDTH
-            y = random.randint(0, WINDOWHEIGHT)
+            y = spawns.randint(0, WINDOWHEIGHT)
         elif spawn_loc == 2: # bottom
-            x = random.randint(0, WINDOWWIDTH)
+            x = spawns.randint(0, WINDOWWIDTH)
             y = WINDOWHEIGHT
         elif spawn_loc == 3: # left
             x = 0
-            y = random.randint(0, WINDOWHEIGHT)
+            y = spawns.randint(0, WINDOWHEIGHT)
 
         return pygame.Rect(x, y, type(self).width, type(self).height)
 
@@ -159,13 +417,17 @@ class Alien(GameObject):
 class TinyAlien(Alien):
     image = (pygame.transform.scale(load_image("alien.png")[0], (25,25)),)
     width, height = image[0].get_size()
+    reward = 10
 
-    def __init__(self, speed=100):
-        Alien.__init__(self, speed, TinyAlien.image)
+    def __init__(self, registry, speed=100):
+        Alien.__init__(self, registry, speed, TinyAlien.image)
 
 class ChangelingAlien(Alien):
-    def __init__(self, speed=100):
-        Alien.__init__(self, speed)
+    changes = rng.stream('changeling')
+    reward = 10
+
+    def __init__(self, registry, speed=100):
+        Alien.__init__(self, registry, speed)
         self._orig_speed = speed
         self._change_timer = 25
 
@@ -174,15 +436,18 @@ class ChangelingAlien(Alien):
         self._change_timer -= 1
         if self._change_timer == 0:
             self._change_timer = 25
-            if random.randint(0,4) == 0: # 20% chance for speed change
-                self._speed = random.randint(0, self._orig_speed+20)
-            if random.randint(0,19) == 0: # 5% chance for shape change
+            changes = ChangelingAlien.changes
+            if changes.randint(0,4) == 0: # 20% chance for speed change
+                self._speed = changes.randint(0, self._orig_speed+20)
+            if changes.randint(0,19) == 0: # 5% chance for shape change
                 if self.rect.width == Alien.width:
                     self.image = TinyAlien.image[0]
+                    self.mask = get_mask(self.image)
                     self.rect = pygame.Rect(self.rect.x, self.rect.y,
                                             TinyAlien.width, TinyAlien.height)
                 else:
                     self.image = Alien.image[0]
+                    self.mask = get_mask(self.image)
                     self.rect = pygame.Rect(self.rect.x, self.rect.y,
                                             Alien.width, Alien.height)
 
@@ -190,16 +455,18 @@ class ChangelingAlien(Alien):
 class SmartAlien(Alien):
     image = load_image("smart_alien.png")
     width, height = image[0].get_size()
+    paths = rng.stream('pathing')
+    reward = 12.5
 
-    def __init__(self, speed=100):
-        Alien.__init__(self, speed, SmartAlien.image)
+    def __init__(self, registry, speed=100):
+        Alien.__init__(self, registry, speed, SmartAlien.image)
         self._true_destination = self.destination
         self._new_destination()
 
     def _new_destination(self):
         lv = Vector2(self.rect.x, self.rect.y)
         candidates = get_n_points_on_circle(lv, 75)
-        random.shuffle(candidates)
+        SmartAlien.paths.shuffle(candidates)
         for i in candidates:
             # find first point that is closer
             if i.get_distance_to(self._true_destination) < \
@@ -218,13 +485,16 @@ class SmartAlien(Alien):
 class Bullet(GameObject):
     image = load_image("bullet.png")
     width, height = image[0].get_size()
+    kind = 'bullets'
     speed = 200
 
-    def __init__(self, rect):
-        GameObject.__init__(self, Bullet.image,
+    def __init__(self, registry, rect):
+        GameObject.__init__(self, registry, Bullet.image,
                             pygame.Rect(WINDOWWIDTH/2, WINDOWHEIGHT/2,
                                         Bullet.width, Bullet.height),
                             self._calculate_destination(rect))
+        self.last_rect = self.rect.copy() # where the last step started
+        self.out_of_bounds = False
 
     def _calculate_destination(self, mouse_pos):
         """
@@ -245,30 +515,39 @@ class Bullet(GameObject):
         return (dx, dy)
 
     def update(self, time_passed):
+        # the step that left the screen has been swept for hits by now
+        if self.out_of_bounds:
+            self.kill()
+            return
+        self.last_rect.topleft = self.rect.topleft
         self.move(time_passed, Bullet.speed)
         if self.rect.top <= 0 or self.rect.bottom >= WINDOWHEIGHT \
                or self.rect.left <= 0 or self.rect.right >= WINDOWWIDTH:
-            self.kill()
+            self.out_of_bounds = True
 
 
 class Spawner(object):
+    speeds = rng.stream('spawn_speed')
+
     def __init__(self, klass, speed, n):
         self.klass = klass
         self.speed = speed
         self.n = n
 
-    def spawn(self, difficulty):
+    def spawn(self, registry, difficulty):
         self.n -= 1
         if type(self.speed) == tuple:
-            return self.klass(random.randint(*self.speed) + difficulty)
-        return self.klass(self.speed + difficulty)
+            return self.klass(registry, Spawner.speeds.randint(*self.speed) +
+                              difficulty)
+        return self.klass(registry, self.speed + difficulty)
 
     def empty(self):
         self.n == 0
 
 
 class LevelController(object):
-    def __init__(self, level=1, difficulty=MEDIUM):
+    def __init__(self, registry, level=1, difficulty=MEDIUM):
+        self.registry = registry
         self.spawn_timer = 0
         self.difficulty = difficulty
         self.level = level # overridable for testing specific levels
@@ -304,7 +583,7 @@ class LevelController(object):
 
     def spawn(self):
         for i in range(self.current_level()['multiplier']):
-            self.current_spawner().spawn(self.difficulty)
+            self.current_spawner().spawn(self.registry, self.difficulty)
 
     def current_level(self):
         return self.levels[self.level]
@@ -345,8 +624,427 @@ class LevelController(object):
         }
 
 
+class MemoryMonitor(object):
+    """
+    Keeps the cyclic garbage collector out of the game loop and records how
+    much memory each level churns through.
+
+    With managed gc, the automatic collector is switched off while playing.
+    Young objects are still collected every frame once the generation 0
+    count passes young_budget, which is quick, while full collections are
+    left for level transitions and the pause screen.
+    """
+    def __init__(self, managed=MANAGED_GC, stats=MEMORY_STATS,
+                 young_budget=5000):
+        self.managed = managed
+        self.stats = stats
+        self.young_budget = young_budget
+        self.levels = []
+        self.sizes = {} # bytes per instance, by class name
+        self._level = None
+        self._gc_start = None
+        if stats and hasattr(gc, 'callbacks'):
+            gc.callbacks.append(self._gc_callback)
+
+    def freeze(self):
+        """ Moves everything loaded so far out of reach of the collector """
+        gc.collect()
+        if self.managed and hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    def start_level(self, level):
+        if self.stats:
+            self._level = {'level': level, 'start': time.time(),
+                           'pauses': [], 'created': dict(GameObject.created)}
+        if self.managed:
+            gc.disable()
+
+    def tick(self):
+        # measured a frame after creation, once __init__ has run its course
+        for name, sample in GameObject.samples.items():
+            if sample is not None:
+                self.sizes[name] = entity_size(sample)
+                GameObject.samples[name] = None
+        if self.managed and gc.get_count()[0] > self.young_budget:
+            self._collect(0)
+
+    def collect(self):
+        """ Full collection, for when a hitch will not be noticed """
+        self._collect(2)
+
+    def end_level(self):
+        self.collect()
+        if self._level is None:
+            return
+        level = self._level
+        self._level = None
+        level['duration'] = time.time() - level['start']
+        level['objects'] = len(gc.get_objects())
+        level['rss'] = rss_kb()
+        level['created'] = dict((name, n - level['created'].get(name, 0))
+                                for name, n in GameObject.created.items()
+                                if n > level['created'].get(name, 0))
+        self.levels.append(level)
+
+    def report(self):
+        if self._level is not None:
+            self.end_level()
+        for level in self.levels:
+            pauses = level['pauses']
+            print('level %(level)s: %(duration).1fs, %(objects)s objects, '
+                  'rss %(rss)s kB' % level)
+            if pauses:
+                print('  gc: %d pauses, %.2fms total, %.2fms max' %
+                      (len(pauses), sum(pauses) * 1000, max(pauses) * 1000))
+            for name, n in sorted(level['created'].items()):
+                if name in self.sizes:
+                    print('  %s: %d created, %.1f kB' %
+                          (name, n, n * self.sizes[name] / 1024.))
+                else:
+                    print('  %s: %d created' % (name, n))
+
+    def _collect(self, generation):
+        # with gc.callbacks available the pause is timed there instead
+        start = time.time()
+        gc.collect(generation)
+        if self._level is not None and not hasattr(gc, 'callbacks'):
+            self._level['pauses'].append(time.time() - start)
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.time()
+        elif self._gc_start is not None and self._level is not None:
+            self._level['pauses'].append(time.time() - self._gc_start)
+
+def entity_size(obj):
+    """ Bytes held by a game object itself, not its shared image and mask """
+    size = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+    for value in obj.__dict__.values():
+        if not isinstance(value, (pygame.Surface, pygame.mask.Mask)):
+            size += sys.getsizeof(value)
+    return size
+
+def rss_kb():
+    """ Resident set size in kB, or None where it can't be read """
+    try:
+        statm = open('/proc/self/statm')
+        try:
+            pages = int(statm.read().split()[1])
+        finally:
+            statm.close()
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource # peak rather than current, but better than nothing
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            rss //= 1024 # bytes there, kB everywhere else
+        return rss
+    except ImportError:
+        return None
+
+
+class FrameRecorder(object):
+    """
+    Records the display surface on a background thread.
+
+    Frames are copied straight from the surface's pixel buffer into one of
+    a fixed set of preallocated buffers, so grabbing a frame is a single
+    memory copy with nothing allocated. When every buffer is still waiting
+    for the writer the frame is dropped and counted instead. Slow frames
+    are still recorded; they are the ones worth looking at.
+    """
+    def __init__(self, surface, mode, directory=CAPTURE_DIR,
+                 command=CAPTURE_COMMAND, queue_size=CAPTURE_QUEUE):
+        self.surface = surface
+        self.mode = mode
+        self.directory = directory
+        self.frames = 0
+        self.written = 0
+        self.dropped = 0 # writer fell behind
+        self.failed = 0 # the encoder or the disk refused the frame
+        self._frame_size = surface.get_pitch() * surface.get_height()
+        self._free = queue.Queue()
+        for i in range(queue_size):
+            self._free.put(bytearray(self._frame_size))
+        self._pending = queue.Queue()
+        self._pipe = None
+        if mode == 'pipe':
+            self._pipe = subprocess.Popen(command, shell=True,
+                                          stdin=subprocess.PIPE)
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._write_format()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def capture(self):
+        """ Called once per frame, after the display has been updated """
+        self.frames += 1
+        try:
+            buf = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        pixels = self.surface.get_buffer() # locks the surface until released
+        memoryview(buf)[:] = memoryview(pixels)
+        del pixels
+        self._pending.put((self.frames, buf))
+
+    def stop(self):
+        self._pending.put(None)
+        self._thread.join()
+        if self._pipe:
+            try:
+                self._pipe.stdin.close()
+            except (IOError, OSError): # the encoder has already gone away
+                pass
+            self._pipe.wait()
+        print('capture: %d frames, %d written, %d dropped, %d failed' %
+              (self.frames, self.written, self.dropped, self.failed))
+
+    def _write_format(self):
+        f = open(os.path.join(self.directory, 'format.txt'), 'w')
+        try:
+            f.write('size %dx%d\npitch %d\nbytesize %d\nmasks %s\n' %
+                    (self.surface.get_size() + (self.surface.get_pitch(),
+                     self.surface.get_bytesize(),
+                     ' '.join('%#x' % m for m in self.surface.get_masks()))))
+        finally:
+            f.close()
+
+    def _run(self):
+        scratch = None
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            number, buf = item
+            try:
+                if self._pipe:
+                    self._pipe.stdin.write(buf)
+                elif self.mode == 'png':
+                    if scratch is None:
+                        scratch = pygame.Surface(self.surface.get_size(), 0,
+                                                 self.surface)
+                    scratch.get_buffer().write(bytes(buf), 0)
+                    pygame.image.save(scratch, os.path.join(
+                        self.directory, 'frame_%06d.png' % number))
+                else:
+                    f = open(os.path.join(self.directory,
+                                          'frame_%06d.raw' % number), 'wb')
+                    try:
+                        f.write(buf)
+                    finally:
+                        f.close()
+                self.written += 1
+            except (IOError, OSError, pygame.error):
+                self.failed += 1
+            finally:
+                self._free.put(buf)
+
+
+class IdleScheduler(object):
+    """
+    Sleeps in the event queue while nothing is happening, rather than
+    polling it, and keeps track of the cpu and wall time spent per state
+    (playing, menu, paused, background, ...).
+    """
+    def __init__(self, timeout=IDLE_TIMEOUT, stats=IDLE_STATS):
+        self.timeout = timeout
+        self.stats = stats
+        self.cpu = {}
+        self.wall = {}
+        self.state = 'menu'
+        self._since = (cpu_time(), time.time())
+
+    def enter(self, state):
+        cpu, wall = cpu_time(), time.time()
+        self.cpu[self.state] = (self.cpu.get(self.state, 0) +
+                                cpu - self._since[0])
+        self.wall[self.state] = (self.wall.get(self.state, 0) +
+                                 wall - self._since[1])
+        self.state = state
+        self._since = (cpu, wall)
+
+    def wait(self):
+        """ Next event, or NOEVENT once the timeout has passed """
+        try:
+            return pygame.event.wait(self.timeout)
+        except TypeError: # no timeout before pygame 2
+            return pygame.event.wait()
+
+    def report(self):
+        if not self.stats:
+            return
+        self.enter(self.state)
+        for state in sorted(self.wall):
+            wall = self.wall[state]
+            print('%s: %.1fs cpu in %.1fs (%d%%)' %
+                  (state, self.cpu[state], wall,
+                   wall and round(100 * self.cpu[state] / wall)))
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+class FramePacer(object):
+    """
+    Paces the game loop using one of the PACING strategies and measures
+    the result where it matters, at the display: frame interval jitter,
+    missed deadlines (frames presented more than half a frame late) and
+    the latency from reading input to presenting the frame.
+
+    With vsync the first calibration_frames are drawn without a frame cap
+    worth mentioning. Their median interval is taken as the refresh period
+    and becomes the frame budget; a median far too short for any display
+    means the driver ignored vsync, and the pacer falls back to 'hybrid'.
+    Frames then follow the display while steps() keeps the game itself at
+    FPS steps per second.
+    """
+    calibration_frames = 60
+    fastest_refresh = 1. / 160 # anything quicker can't be a real vblank
+    max_steps = 5 # after a stall, catch up this far and drop the rest
+
+    def __init__(self, clock, mode=PACING, fps=FPS, stats=PACING_STATS,
+                 throttled_fps=UNFOCUSED_FPS):
+        self.clock = clock
+        self.mode = mode
+        self.requested_mode = PACING
+        self.fps = fps
+        self.throttled_fps = throttled_fps
+        self.throttled = False
+        self.stats = stats
+        self.budget = 1. / fps
+        self.refresh = None # measured refresh period, with vsync
+        self._samples = []
+        self._pending = 0. # time not yet simulated, with fixed steps
+        self.frames = 0
+        self.missed = 0
+        self._mean = self._m2 = 0. # running interval mean and variance
+        self._worst = 0.
+        self._latency = self._worst_latency = 0.
+        self._latencies = 0
+        self._last = self._polled = None
+
+    def tick(self):
+        """ Waits for the next frame, returns ms since the last one """
+        if self.throttled:
+            return self.clock.tick(self.throttled_fps)
+        if self.mode == 'hybrid':
+            return self.clock.tick_busy_loop(self.fps)
+        if self.mode == 'vsync':
+            # display.update waits for the vblank. Until calibrated the cap
+            # is loose so that a driver ignoring vsync shows itself; after
+            # that it only guards against vsync that stops working
+            if self.refresh is None:
+                return self.clock.tick(1000)
+            return self.clock.tick(1.25 / self.refresh)
+        return self.clock.tick(self.fps)
+
+    def steps(self, frame_ms):
+        """
+        The game steps (dt in seconds) to run before drawing this frame.
+        Paced at FPS that is simply one step per frame; with vsync or while
+        throttled the frame time is split into as many 1/FPS steps as have
+        come due.
+        """
+        if self.mode != 'vsync' and not self.throttled:
+            return [frame_ms / 1000.]
+        step = 1. / self.fps
+        self._pending += frame_ms / 1000.
+        n = int(self._pending / step)
+        self._pending -= n * step
+        return [step] * min(n, self.max_steps)
+
+    def throttle(self, throttled):
+        """
+        Slows down to throttled_fps, for a window nobody is looking at; the
+        caller skips drawing meanwhile. Throttled frames are not measured.
+        """
+        self.throttled = throttled
+        self.reset()
+
+    def missed_ms(self):
+        """ Frames longer than this count as missed """
+        return MISSED_FRAME * self.budget * 1000
+
+    def reset(self):
+        """ Forgets the time spent outside the game loop """
+        self.clock.tick()
+        self._last = self._polled = None
+        self._pending = 0.
+
+    def input_polled(self):
+        self._polled = timer()
+
+    def presented(self):
+        now = timer()
+        if self._last is not None:
+            interval = now - self._last
+            self.frames += 1
+            delta = interval - self._mean
+            self._mean += delta / self.frames
+            self._m2 += delta * (interval - self._mean)
+            self._worst = max(self._worst, interval)
+            if self.mode == 'vsync' and self.refresh is None:
+                self._calibrate(interval)
+            elif interval > self.budget * MISSED_FRAME:
+                self.missed += 1
+        if self._polled is not None:
+            latency = now - self._polled
+            self._latencies += 1
+            self._latency += latency
+            self._worst_latency = max(self._worst_latency, latency)
+            self._polled = None
+        self._last = now
+
+    def _calibrate(self, interval):
+        self._samples.append(interval)
+        if len(self._samples) < self.calibration_frames:
+            return
+        median = sorted(self._samples)[len(self._samples) // 2]
+        self._samples = []
+        if median < self.fastest_refresh:
+            self.mode = 'hybrid' # vsync accepted, but not honoured
+            self._pending = 0.
+        else:
+            self.refresh = self.budget = median
+
+    def jitter(self):
+        """ Standard deviation of the frame interval, in seconds """
+        if self.frames < 2:
+            return 0.
+        return math.sqrt(self._m2 / (self.frames - 1))
+
+    def report(self):
+        if not self.stats or not self.frames:
+            return
+        if self.mode != self.requested_mode:
+            print('%s pacing was not available, used %s' %
+                  (self.requested_mode, self.mode))
+        if self.refresh:
+            print('display refresh: %.1fHz' % (1. / self.refresh))
+        print('%s pacing: %d frames, interval %.2fms (max %.2fms), '
+              'jitter %.2fms, %d missed' %
+              (self.mode, self.frames, self._mean * 1000,
+               self._worst * 1000, self.jitter() * 1000, self.missed))
+        if self._latencies:
+            print('input to display: %.2fms mean, %.2fms max' %
+                  (self._latency / self._latencies * 1000,
+                   self._worst_latency * 1000))
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
 bg = load_image("bg.jpg")
 clock = pygame.time.Clock()
+pacer = FramePacer(clock, pacing)
+idle = IdleScheduler()
 
 # Fonts
 title_font = pygame.font.SysFont(None, 48)
@@ -360,6 +1058,11 @@ game_over_sound = load_sound("gameover.wav")
 levelup_sound = load_sound("levelup.wav")
 if pygame.mixer.get_init():
     pygame.mixer.music.load(os.path.join("data", "background.mid"))
+frame_recorder = CAPTURE and FrameRecorder(screen, CAPTURE)
+stats = StatsStore(STATS_FILE)
+session = None
+memory_monitor = MemoryMonitor()
+memory_monitor.freeze()
 
 # show the "Start" screen
 screen.blit(*bg)
@@ -383,10 +1086,9 @@ difficulty = wait_for_player()
 
 while True:
     # setup
+    rng.seed(SEED)
     game_over, game_finished, muted = False, False, False
-    aliens = pygame.sprite.Group()
-    bullets = pygame.sprite.Group()
-    allsprites = pygame.sprite.RenderUpdates()
+    entities = EntityRegistry()
     aliens_killed = 0
     firepower = 50
     shots = 0
@@ -399,36 +1101,41 @@ while True:
     else:
         difficulty = MEDIUM
 
-    Player.containers = allsprites
-    Alien.containers = aliens, allsprites
-    Bullet.containers = bullets, allsprites
-    Explosion.containers = allsprites
-
-    level_controller = LevelController(1, difficulty)
+    level_controller = LevelController(entities, 1, difficulty)
+    memory_monitor.start_level(level_controller.level)
+    session = stats.start_session(
+        ".".join([str(x) for x in SPACESWARM_VERSION]), difficulty,
+        rng.base_seed)
+    level_started, frame_times = time.time(), []
     if pygame.mixer.get_init(): pygame.mixer.music.play(-1, 0.0)
 
-    player = Player()
+    player = Player(entities)
 
     while True: # Game loop
+        pacer.input_polled()
         for event in pygame.event.get():
             if event.type is MOUSEBUTTONDOWN:
                 if pygame.mouse.get_pressed() == (1,0,0) and firepower > 10:
                     if not muted: weapon_sound.play()
                     firepower -= 7.5
                     shots += 1
-                    Bullet(pygame.mouse.get_pos())
+                    stats.event(session, level_controller.level, 'shot')
+                    Bullet(entities, pygame.mouse.get_pos())
                 elif pygame.mouse.get_pressed() == (0,0,1) and firepower > 100:
                     if not muted: weapon_sound.play()
                     firepower -= 75
                     shots += 8
-                    Bullet((0, 0)) # top left
-                    Bullet((WINDOWWIDTH/2, 0)) # top middle
-                    Bullet((WINDOWWIDTH, 0)) # top right
-                    Bullet((WINDOWWIDTH, WINDOWHEIGHT/2)) # right
-                    Bullet((WINDOWWIDTH, WINDOWHEIGHT)) # bottom right
-                    Bullet((WINDOWWIDTH/2, WINDOWHEIGHT)) # bottom middle
-                    Bullet((0, WINDOWHEIGHT)) # bottom left
-                    Bullet((0, WINDOWHEIGHT/2)) # left
+                    stats.event(session, level_controller.level, 'burst',
+                                count=8)
+                    entities.spawn(Bullet, [
+                        (0, 0), # top left
+                        (WINDOWWIDTH/2, 0), # top middle
+                        (WINDOWWIDTH, 0), # top right
+                        (WINDOWWIDTH, WINDOWHEIGHT/2), # right
+                        (WINDOWWIDTH, WINDOWHEIGHT), # bottom right
+                        (WINDOWWIDTH/2, WINDOWHEIGHT), # bottom middle
+                        (0, WINDOWHEIGHT), # bottom left
+                        (0, WINDOWHEIGHT/2)]) # left
 
             elif event.type is KEYDOWN:
                 if event.key == K_SPACE:
@@ -437,12 +1144,20 @@ while True:
                         screen.fill(RED)
                         pygame.display.flip()
                         firepower -= 150
-                        aliens_killed += len(aliens)
-                        for a in aliens: a.kill()
+                        nuked = entities.clear('aliens')
+                        aliens_killed += sum(nuked.values())
+                        stats.event(session, level_controller.level, 'nuke',
+                                    count=sum(nuked.values()))
+                        for klass, n in nuked.items():
+                            stats.event(session, level_controller.level,
+                                        'kill', klass.__name__, n)
                 elif event.key == K_ESCAPE or event.key == K_q:
                     terminate()
                 elif event.key == K_p:
-                    wait_for_player()
+                    memory_monitor.collect()
+                    paused = time.time()
+                    wait_for_player('paused')
+                    level_started += time.time() - paused # not level time
                 elif event.key == K_m:
                     if muted:
                         pygame.mixer.music.unpause()
@@ -453,41 +1168,67 @@ while True:
             elif event.type is QUIT:
                 terminate()
 
-        if firepower < 100:
-            firepower += 0.15
-        else:
-            firepower += (30/(firepower*1.5))/2
-
-        level_controller.tick() # spawns new aliens
+        if PAUSE_MINIMIZED and not window_visible():
+            memory_monitor.collect()
+            paused = time.time()
+            wait_for_window()
+            level_started += time.time() - paused
+        if window_focused() == pacer.throttled:
+            pacer.throttle(not pacer.throttled)
+            idle.enter(pacer.throttled and 'unfocused' or 'playing')
+
+        frame_ms = pacer.tick()
+        if not pacer.throttled: frame_times.append(frame_ms)
+        memory_monitor.tick()
+
+        # the game rules count steps, so they run at FPS however fast we draw
+        for dt in pacer.steps(frame_ms):
+            if firepower < 100:
+                firepower += 0.15
+            else:
+                firepower += (30/(firepower*1.5))/2
 
-        # collision detection
-        if pygame.sprite.spritecollide(player, aliens, 1):
-            game_over = True
-            break
+            level_controller.tick() # spawns new aliens
 
-        # TODO ma finna ut firepower mechanics, koss ska den oka
-        for a in pygame.sprite.groupcollide(aliens, bullets, 1, 1).keys():
-            Explosion(a.rect)
-            a.kill()
-            aliens_killed += 1
-            accuracy = int(round((float(aliens_killed)/shots)*100))
-            if isinstance(a, SmartAlien):
-                firepower += 12.5
-            elif isinstance(a, TinyAlien) or isinstance(a, ChangelingAlien):
-                firepower += 10
-            else:
-                firepower += 7.5 # regular alien
-            if not muted: alien_killed_sound.play()
-
-        # FIXME
-        if level_controller.current_spawner().n == 0 and len(aliens) == 0:
-            if not muted: levelup_sound.play()
-            firepower += 25
-            if level_controller.is_game_finished():
-                game_finished = True
+            # collision detection
+            if spritecollide(player, entities.aliens, 1):
+                game_over = True
                 break
-            else:
-                level_controller.level_up()
+
+            # TODO ma finna ut firepower mechanics, koss ska den oka
+            hits = sweptcollide(entities.aliens, entities.bullets, 1, 1)
+            for a in hits.keys():
+                Explosion(entities, a.rect)
+                a.kill()
+                aliens_killed += 1
+                stats.event(session, level_controller.level, 'kill',
+                            type(a).__name__)
+                accuracy = int(round((float(aliens_killed)/shots)*100))
+                firepower += a.reward
+                if not muted: alien_killed_sound.play()
+
+            # FIXME
+            if level_controller.current_spawner().n == 0 and \
+                   len(entities.aliens) == 0:
+                if not muted: levelup_sound.play()
+                firepower += 25
+                if level_controller.is_game_finished():
+                    game_finished = True
+                    break
+                else:
+                    memory_monitor.end_level()
+                    stats.end_level(session, level_controller.level,
+                                    level_started, frame_times,
+                                    pacer.missed_ms())
+                    level_started, frame_times = time.time(), []
+                    level_controller.level_up()
+                    memory_monitor.start_level(level_controller.level)
+
+            entities.update(dt)
+        if game_over or game_finished:
+            break
+        if pacer.throttled:
+            continue # the game goes on, but nobody is watching it
 
         # Redraw screen
         screen.blit(*bg)
@@ -503,12 +1244,19 @@ while True:
                  font, screen, WINDOWWIDTH/2, 0)
         draw_text('Accuracy: %s' % accuracy, font, screen, WINDOWWIDTH/2, 20)
 
-        allsprites.update(clock.tick(FPS) / 1000.)
-        allsprites.draw(screen)
+        entities.draw(screen)
         screen.blit(scope_image, pygame.mouse.get_pos())
         pygame.display.update()
+        pacer.presented()
+        if frame_recorder: frame_recorder.capture()
 
     # broken out of game loop
+    memory_monitor.end_level()
+    stats.end_level(session, level_controller.level, level_started,
+                    frame_times, pacer.missed_ms())
+    stats.end_session(session, game_over and 'game over' or 'finished',
+                      level_controller.level)
+    session = None
     if pygame.mixer.get_init(): pygame.mixer.music.stop()
     if game_over:
         if not muted: game_over_sound.play()
@@ -525,4 +1273,4 @@ while True:
         draw_text('Press any key to play again, or Esc to quit.', font,
              screen, (WINDOWWIDTH / 3) - 80, (WINDOWHEIGHT / 3) + 150)
     pygame.display.update()
-    difficulty = wait_for_player()
+    difficulty = wait_for_player('game over')
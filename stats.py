@@ -0,0 +1,157 @@
+"""
+Session statistics for Space Swarm, stored in a local SQLite file.
+
+The game only ever puts events on a queue; a background thread writes them
+to disk in batches. The query methods open their own connection, so they can
+be used from a separate script without starting the game.
+"""
+
+import sqlite3, threading, time, uuid
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY, started REAL, ended REAL, version TEXT,
+    difficulty INTEGER, seed INTEGER, outcome TEXT, level INTEGER);
+CREATE TABLE IF NOT EXISTS levels (
+    session TEXT, level INTEGER, started REAL, duration REAL,
+    frames INTEGER, frame_ms_mean REAL, frame_ms_p95 REAL,
+    frame_ms_max REAL, missed INTEGER);
+CREATE TABLE IF NOT EXISTS events (
+    session TEXT, level INTEGER, time REAL, kind TEXT, detail TEXT,
+    count INTEGER);
+"""
+
+
+class StatsStore(object):
+    """
+    Queues statistics from the game loop and writes them in batches of up to
+    batch_size, at least every flush_interval seconds. With path None nothing
+    is recorded.
+    """
+    def __init__(self, path, batch_size=200, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        if path is None:
+            return
+        conn = sqlite3.connect(path)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start_session(self, version, difficulty, seed=None):
+        session = uuid.uuid4().hex
+        self._put('INSERT INTO sessions (id, started, version, difficulty, '
+                  'seed) VALUES (?, ?, ?, ?, ?)',
+                  (session, time.time(), version, difficulty, seed))
+        return session
+
+    def end_session(self, session, outcome, level):
+        self._put('UPDATE sessions SET ended = ?, outcome = ?, level = ? '
+                  'WHERE id = ?', (time.time(), outcome, level, session))
+
+    def event(self, session, level, kind, detail=None, count=1):
+        """ A shot, burst, nuke or kill (detail is the alien type) """
+        self._put('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                  (session, level, time.time(), kind, detail, count))
+
+    def end_level(self, session, level, started, frame_times, missed_ms):
+        """
+        Summarizes the frame times (ms) of a finished level; frames longer
+        than missed_ms count as missed.
+        """
+        frames = sorted(frame_times)
+        n = len(frames)
+        if n:
+            mean = sum(frames) / float(n)
+            p95 = frames[min(n - 1, int(n * 0.95))]
+            worst = frames[-1]
+        else:
+            mean = p95 = worst = None
+        missed = len([f for f in frames if f > missed_ms])
+        self._put('INSERT INTO levels VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                  (session, level, started, time.time() - started, n,
+                   mean, p95, worst, missed))
+
+    def close(self):
+        """ Writes whatever is still queued and stops the writer """
+        if self._queue is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._queue = None
+
+    # Aggregates across all recorded sessions
+
+    def kills_by_alien(self):
+        return self._query('SELECT detail, SUM(count) FROM events '
+                           "WHERE kind = 'kill' GROUP BY detail "
+                           'ORDER BY detail')
+
+    def level_summary(self):
+        """
+        Per level: times played, mean duration, shots, kills, nukes, mean
+        and worst 95th percentile frame time, and missed frames.
+        """
+        return self._query("""
+            SELECT l.level, COUNT(*), AVG(l.duration),
+                   (SELECT SUM(count) FROM events
+                    WHERE level = l.level AND kind IN ('shot', 'burst')),
+                   (SELECT SUM(count) FROM events
+                    WHERE level = l.level AND kind = 'kill'),
+                   (SELECT COUNT(*) FROM events
+                    WHERE level = l.level AND kind = 'nuke'),
+                   AVG(l.frame_ms_mean), MAX(l.frame_ms_p95), SUM(l.missed)
+            FROM levels l GROUP BY l.level ORDER BY l.level""")
+
+    def session_summary(self):
+        """ Sessions by outcome: count, mean level reached, mean length """
+        return self._query('SELECT outcome, COUNT(*), AVG(level), '
+                           'AVG(ended - started) FROM sessions '
+                           'GROUP BY outcome ORDER BY outcome')
+
+    def _query(self, sql):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def _put(self, sql, params):
+        if self._queue is not None:
+            self._queue.put((sql, params))
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        running = True
+        while running:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback() # losing a batch beats stalling the game
+        conn.close()